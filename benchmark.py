@@ -0,0 +1,147 @@
+import os
+import re
+import sys
+import hmac
+import json
+import time
+import base64
+import hashlib
+import subprocess
+
+
+def bench_line_webhook(channels=128, requests_per_channel=50):
+    import line
+
+    secrets = {}
+    for i in range(channels):
+        bot_id = f'U{i:032x}'
+        secrets[bot_id] = f'secret-{i}'
+        channel = line.LineChannel(bot_id, secrets[bot_id], f'token-{i}')
+        line.line_channels[bot_id] = (channel, time.monotonic())
+    payloads = []
+    for bot_id, secret in secrets.items():
+        body = json.dumps({'destination': bot_id, 'events': []})
+        signature = base64.b64encode(hmac.new(secret.encode(), body.encode(), hashlib.sha256).digest()).decode()
+        payloads.append((body, signature))
+
+    start = time.perf_counter()
+    for _ in range(requests_per_channel):
+        for body, signature in payloads:
+            hmac.new(secrets[json.loads(body)['destination']].encode(), body.encode(), hashlib.sha256).digest()
+    fresh = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(requests_per_channel):
+        for body, signature in payloads:
+            line.line_channels[json.loads(body)['destination']][0].validate(body, signature)
+    precomputed = time.perf_counter() - start
+    total = channels * requests_per_channel
+    print(f'[bench_line_webhook] verify fresh key: {total / fresh:.0f}/s, precomputed key: {total / precomputed:.0f}/s')
+
+    client = line.application.test_client()
+    start = time.perf_counter()
+    for _ in range(requests_per_channel):
+        for body, signature in payloads:
+            response = client.post('/callback', data=body, headers={
+                'X-Line-Signature': signature,
+                'Content-Type': 'application/json'
+            })
+            assert response.status_code == 200, response.status_code
+    elapsed = time.perf_counter() - start
+    print(f'[bench_line_webhook] {total} webhooks across {channels} channels in {elapsed:.2f}s '
+          f'({total / elapsed:.0f} webhooks/sec)')
+
+
+def bench_messages_json(sizes=(10000, 100000)):
+    import zlib
+    from datetime import datetime
+    from datetime import timedelta
+    from serialize import brotli
+    from serialize import compress_stream
+    from serialize import format_timestamps
+    from serialize import iter_batches
+    from serialize import stream_json_array
+
+    for size in sizes:
+        base = datetime(2024, 1, 1)
+        rows = [{
+            'message_type': 'text',
+            'message_content': f'message number {i} in a fairly busy group chat',
+            'user_id': f'U{i % 50:032x}',
+            'created_at': base + timedelta(seconds=i * 7, microseconds=i)
+        } for i in range(size)]
+
+        start = time.perf_counter()
+        body = json.dumps([{
+            'type': row.get('message_type'),
+            'content': row.get('message_content'),
+            'user_id': row.get('user_id'),
+            'user_name': row.get('user_id'),
+            'timestamp': row.get('created_at').strftime('%Y-%m-%d %H:%M:%S')
+        } for row in rows]).encode()
+        baseline = time.perf_counter() - start
+
+        def batches():
+            for batch in iter_batches(rows):
+                timestamps = format_timestamps(batch)
+                yield [{
+                    'type': row.get('message_type'),
+                    'content': row.get('message_content'),
+                    'user_id': row.get('user_id'),
+                    'user_name': row.get('user_id'),
+                    'timestamp': timestamp
+                } for row, timestamp in zip(batch, timestamps)]
+
+        start = time.perf_counter()
+        streamed = b''.join(stream_json_array(batches()))
+        fast = time.perf_counter() - start
+        assert json.loads(streamed) == json.loads(body)
+        print(f'[bench_messages_json] {size} messages: json {baseline * 1000:.1f}ms, '
+              f'orjson stream {fast * 1000:.1f}ms, identity {len(streamed)} bytes')
+        for encoding in ('gzip', 'br'):
+            if encoding == 'br' and brotli is None:
+                continue
+            start = time.perf_counter()
+            compressed = b''.join(compress_stream(stream_json_array(batches()), encoding))
+            elapsed = time.perf_counter() - start
+            if encoding == 'gzip':
+                assert zlib.decompress(compressed, 31) == streamed
+            print(f'[bench_messages_json] {size} messages: {encoding} {elapsed * 1000:.1f}ms, {len(compressed)} bytes')
+
+
+def bench_startup(services=('line', 'telegram', 'chatbot')):
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    first_request = (
+        'import time; start = time.perf_counter(); '
+        'import {0}; {0}.application.test_client().get("/"); '
+        'print(time.perf_counter() - start)'
+    )
+    for service in services:
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {service}'],
+            cwd=cwd, capture_output=True, text=True, check=True
+        )
+        import_us = 0
+        for row in result.stderr.splitlines():
+            match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| (.*)$', row)
+            if match and match.group(2).strip() == service:
+                import_us = int(match.group(1))
+        result = subprocess.run(
+            [sys.executable, '-c', first_request.format(service)],
+            cwd=cwd, capture_output=True, text=True, check=True
+        )
+        elapsed = float(result.stdout.strip().splitlines()[-1])
+        print(f'[bench_startup] {service}: import {import_us / 1000:.1f}ms, '
+              f'time to first request {elapsed * 1000:.1f}ms')
+
+
+BENCHMARKS = {
+    'line_webhook': bench_line_webhook,
+    'messages_json': bench_messages_json,
+    'startup': bench_startup
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
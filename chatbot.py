@@ -1,11 +1,17 @@
+import io
 import os
 import re
 import json
+import time
+import base64
+import hashlib
+import threading
 
+from collections import OrderedDict
 from flask import Flask
 from flask import jsonify
 from flask import request
-from openai import OpenAI
+from flask import Blueprint
 from dotenv import load_dotenv
 
 
@@ -15,12 +21,120 @@ load_dotenv()
 GPT_4O_MODEL = os.getenv('GPT_4O_MODEL')
 GPT_KEY = os.getenv('GPT_KEY')
 
-application = Flask(__name__)
-application.config['CORS_HEADERS'] = 'Content-Type'
-application.config['CORS_RESOURCES'] = {r'/api/*': {'origins': '*'}}
-application.config['PROPAGATE_EXCEPTIONS'] = True
+blueprint = Blueprint('chatbot', __name__)
 
-client = OpenAI(api_key=GPT_KEY)
+client = None
+client_lock = threading.Lock()
+
+# gpt-4o scales images to fit 2048x2048 and then to 768px on the shortest side,
+# so anything larger only costs bandwidth.
+IMAGE_MAX_SIDE = 2048
+IMAGE_MAX_SHORT_SIDE = 768
+IMAGE_JPEG_QUALITY = 85
+IMAGE_CACHE_SIZE = 256
+
+image_cache = OrderedDict()
+image_cache_lock = threading.Lock()
+
+
+def get_client():
+    global client
+    if client is None:
+        with client_lock:
+            if client is None:
+                from openai import OpenAI
+                client = OpenAI(api_key=GPT_KEY)
+    return client
+
+
+def preprocess_image(url):
+    match = re.match(r'data:image/[\w.+-]+;base64,(.+)', url, re.DOTALL)
+    if not match:
+        return None, url
+    try:
+        raw = base64.b64decode(match.group(1), validate=True)
+    except ValueError as e:
+        print(f'[preprocess_image] invalid base64, forwarding unchanged: {e}')
+        return None, url
+    digest = hashlib.sha256(raw).hexdigest()
+    with image_cache_lock:
+        if digest in image_cache:
+            image_cache.move_to_end(digest)
+            return digest, image_cache[digest]
+    from PIL import Image
+    from PIL import ImageOps
+    try:
+        image = Image.open(io.BytesIO(raw))
+        image.load()
+        image = ImageOps.exif_transpose(image)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        print(f'[preprocess_image] {digest[:12]}: cannot decode image, forwarding unchanged: {e}')
+        return None, url
+    width, height = image.size
+    scale = min(1.0, IMAGE_MAX_SIDE / max(width, height), IMAGE_MAX_SHORT_SIDE / min(width, height))
+    if scale < 1.0:
+        image = image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+    encoded = f'data:image/jpeg;base64,{base64.b64encode(buffer.getvalue()).decode()}'
+    if len(encoded) >= len(url):
+        encoded = url
+    print(f'[preprocess_image] {digest[:12]}: {width}x{height} -> {image.size[0]}x{image.size[1]}, '
+          f'{len(url)} -> {len(encoded)} bytes')
+    with image_cache_lock:
+        image_cache[digest] = encoded
+        while len(image_cache) > IMAGE_CACHE_SIZE:
+            image_cache.popitem(last=False)
+    return digest, encoded
+
+
+def preprocess_messages(user_messages):
+    messages = []
+    seen = {}
+    image_count = 0
+    for m in user_messages:
+        message = m.copy()
+        content = message.get('content')
+        if isinstance(content, list):
+            parts = []
+            for part in content:
+                if part.get('type') != 'image_url':
+                    parts.append(part)
+                    continue
+                image_url = part.get('image_url') or {}
+                digest, url = preprocess_image(image_url.get('url', ''))
+                if digest is not None and digest in seen:
+                    parts.append({'type': 'text', 'text': f'[Same image as image #{seen[digest]} above]'})
+                    continue
+                image_count += 1
+                if digest is not None:
+                    seen[digest] = image_count
+                parts.append({'type': 'image_url', 'image_url': {**image_url, 'url': url}})
+            message['content'] = parts
+        messages.append(message)
+    return messages
+
+
+def payload_bytes(messages):
+    total = 0
+    for m in messages:
+        content = m.get('content')
+        if isinstance(content, str):
+            total += len(content.encode('utf-8'))
+        elif isinstance(content, list):
+            for part in content:
+                if part.get('type') == 'image_url':
+                    total += len((part.get('image_url') or {}).get('url', '').encode('utf-8'))
+                else:
+                    total += len(part.get('text', '').encode('utf-8'))
+    return total
 
 
 def get_response(user_messages):
@@ -30,17 +144,22 @@ def get_response(user_messages):
         'Finally, return **only** a strictly valid JSON object in the form:\n'
         '{"response": "<your answer>", "questions": ["...", "...", "..."]}'
     )
-    messages = [m.copy() for m in user_messages]
+    start = time.perf_counter()
+    messages = preprocess_messages(user_messages)
     for i in range(len(messages) - 1, -1, -1):
         if messages[i].get('role') == 'user':
             messages[i]['content'].append({'type': 'text', 'text': system_instruction})
             break
     print(f'[get_response] {messages}')
-    response = client.chat.completions.create(
+    original_bytes = payload_bytes(user_messages)
+    upstream_bytes = payload_bytes(messages)
+    response = get_client().chat.completions.create(
         model=GPT_4O_MODEL,
         messages=messages,
         temperature=0
     )
+    print(f'[get_response] upstream bytes: {upstream_bytes} (original {original_bytes}), '
+          f'latency: {time.perf_counter() - start:.3f}s')
     return response.choices[0].message.content
 
 
@@ -72,7 +191,12 @@ def extract_json(text):
     return {}
 
 
-@application.route('/api/chat', methods=['POST'])
+@blueprint.route('/', methods=['GET'])
+def test():
+    return 'OK'
+
+
+@blueprint.route('/api/chat', methods=['POST'])
 def chat():
     data = request.get_json(silent=True) or {}
     try:
@@ -85,5 +209,17 @@ def chat():
         return jsonify({'error': str(exc)}), 500
 
 
+def create_app():
+    app = Flask(__name__)
+    app.config['CORS_HEADERS'] = 'Content-Type'
+    app.config['CORS_RESOURCES'] = {r'/api/*': {'origins': '*'}}
+    app.config['PROPAGATE_EXCEPTIONS'] = True
+    app.register_blueprint(blueprint)
+    return app
+
+
+application = create_app()
+
+
 if __name__ == '__main__':
     application.run(host='0.0.0.0', port=5050)
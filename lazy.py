@@ -0,0 +1,32 @@
+import threading
+
+
+MONGO_HOST = 'localhost'
+MONGO_PORT = 27017
+
+mongo_client = None
+mongo_client_lock = threading.Lock()
+
+
+def get_mongo_client():
+    global mongo_client
+    if mongo_client is None:
+        with mongo_client_lock:
+            if mongo_client is None:
+                from pymongo import MongoClient
+                mongo_client = MongoClient(MONGO_HOST, MONGO_PORT)
+    return mongo_client
+
+
+class LazyCollection:
+    """Stands in for a pymongo collection and connects on first use."""
+
+    def __init__(self, db_name, name):
+        self.db_name = db_name
+        self.name = name
+        self.collection = None
+
+    def __getattr__(self, attr):
+        if self.collection is None:
+            self.collection = get_mongo_client()[self.db_name][self.name]
+        return getattr(self.collection, attr)
@@ -3,32 +3,35 @@
 # https://www.linebiz.com/jp-en/service/line-account-connect/entry/
 
 import os
+import sys
+import hmac
+import json
+import time
 import uuid
+import base64
+import hashlib
+import threading
 
+from collections import OrderedDict
+
+from flask import g
 from flask import abort
 from flask import Flask
 from flask import jsonify
 from flask import request
+from flask import Blueprint
 from flask import send_from_directory
 from datetime import datetime
 from dotenv import load_dotenv
-from pymongo import MongoClient
-from linebot.v3 import WebhookHandler
-from linebot.v3.messaging import ApiClient
-from linebot.v3.messaging import TextMessage
-from linebot.v3.messaging import MessagingApi
-from linebot.v3.messaging import Configuration
-from linebot.v3.messaging import MessagingApiBlob
-from linebot.v3.messaging import BroadcastRequest
-from linebot.v3.messaging import PushMessageRequest
-from linebot.v3.messaging import ReplyMessageRequest
-from linebot.v3.webhooks import JoinEvent
-from linebot.v3.webhooks import MessageEvent
-from linebot.v3.webhooks import TextMessageContent
-from linebot.v3.webhooks import ImageMessageContent
-from linebot.v3.webhooks import VideoMessageContent
-from linebot.v3.webhooks import AudioMessageContent
-from linebot.v3.exceptions import InvalidSignatureError
+from lazy import LazyCollection
+from serialize import BATCH_SIZE
+from serialize import iter_batches
+from serialize import format_timestamps
+from serialize import json_stream_response
+from stats import query_rollups
+from stats import rebuild_rollups
+from stats import parse_stats_args
+from stats import increment_rollups
 
 
 load_dotenv()
@@ -37,33 +40,127 @@ DATA_DIR = os.path.join(os.path.dirname(__file__), os.getenv('DATA_DIR'))
 LINE_DIR = os.path.join(DATA_DIR, os.getenv('LINE_DIR'))
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
 LINE_CHANNEL_SECRET = os.getenv('LINE_CHANNEL_SECRET')
+LINE_CHANNEL_CACHE_TTL = 300
+LINE_CHANNEL_MISS_CACHE_SIZE = 1024
 
 STATIC_DIR = os.path.join(os.path.dirname(__file__), os.getenv('STATIC_DIR'))
 
-os.makedirs(LINE_DIR, exist_ok=True)
-
-application = Flask(__name__)
-application.config['CORS_HEADERS'] = 'Content-Type'
-application.config['CORS_RESOURCES'] = {r'/api/*': {'origins': '*'}}
-application.config['PROPAGATE_EXCEPTIONS'] = True
-
-mongo_client = MongoClient('localhost', 27017)
-line_db = mongo_client['line']
-message_collection = line_db['message']
-user_collection = line_db['user']
-group_collection = line_db['group']
-room_collection = line_db['room']
-
-configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
-
-
-@application.route('/', methods=['GET'])
+blueprint = Blueprint('line', __name__)
+
+message_collection = LazyCollection('line', 'message')
+user_collection = LazyCollection('line', 'user')
+group_collection = LazyCollection('line', 'group')
+room_collection = LazyCollection('line', 'room')
+channel_collection = LazyCollection('line', 'channel')
+rollup_collection = LazyCollection('line', 'message_rollup')
+
+ROLLUP_FIELDS = ('bot_id', 'source_type', 'source_id', 'user_id', 'message_type')
+MESSAGE_PROJECTION = {'_id': 0, 'message_type': 1, 'message_content': 1, 'user_id': 1, 'created_at': 1}
+
+
+class LineChannel:
+    """Credentials of one LINE channel with a precomputed HMAC key and a pooled API client."""
+
+    def __init__(self, bot_id, channel_secret, channel_access_token):
+        self.bot_id = bot_id
+        self.credentials = (channel_secret, channel_access_token)
+        self.mac = hmac.new(channel_secret.encode('utf-8'), digestmod=hashlib.sha256)
+        from linebot.v3.messaging import ApiClient
+        from linebot.v3.messaging import Configuration
+        self.api_client = ApiClient(Configuration(access_token=channel_access_token))
+
+    def validate(self, body, signature):
+        mac = self.mac.copy()
+        mac.update(body.encode('utf-8'))
+        return hmac.compare_digest(base64.b64encode(mac.digest()), signature.encode('utf-8'))
+
+
+default_channel = None
+line_channels = {}
+line_channel_misses = OrderedDict()
+line_channels_lock = threading.Lock()
+
+handler = None
+handler_lock = threading.Lock()
+
+
+def get_handler():
+    global handler
+    if handler is None:
+        with handler_lock:
+            if handler is None:
+                from linebot.v3 import WebhookHandler
+                from linebot.v3.webhooks import JoinEvent
+                from linebot.v3.webhooks import MessageEvent
+                from linebot.v3.webhooks import TextMessageContent
+                from linebot.v3.webhooks import ImageMessageContent
+                from linebot.v3.webhooks import VideoMessageContent
+                from linebot.v3.webhooks import AudioMessageContent
+                # Signatures are checked per channel in callback() before the handler dispatches
+                webhook_handler = WebhookHandler(LINE_CHANNEL_SECRET or '', skip_signature_verification=lambda: True)
+                webhook_handler.add(JoinEvent)(handle_member_joined)
+                webhook_handler.add(MessageEvent, message=TextMessageContent)(handle_text_message)
+                webhook_handler.add(
+                    MessageEvent, message=(ImageMessageContent, VideoMessageContent, AudioMessageContent)
+                )(handle_content_message)
+                handler = webhook_handler
+    return handler
+
+
+def get_default_channel():
+    global default_channel
+    if default_channel is None and LINE_CHANNEL_SECRET and LINE_CHANNEL_ACCESS_TOKEN:
+        with line_channels_lock:
+            if default_channel is None:
+                default_channel = LineChannel(None, LINE_CHANNEL_SECRET, LINE_CHANNEL_ACCESS_TOKEN)
+    return default_channel
+
+
+def get_channel(bot_id):
+    with line_channels_lock:
+        channel, loaded_at = line_channels.get(bot_id, (None, 0))
+        missed_at = line_channel_misses.get(bot_id, 0)
+    now = time.monotonic()
+    if channel and now - loaded_at < LINE_CHANNEL_CACHE_TTL:
+        return channel
+    if missed_at and now - missed_at < LINE_CHANNEL_CACHE_TTL:
+        return None
+    doc = channel_collection.find_one({'bot_id': bot_id})
+    if not doc:
+        # Misses are kept in a bounded cache since bot_id may come from an unauthenticated request
+        with line_channels_lock:
+            line_channels.pop(bot_id, None)
+            line_channel_misses[bot_id] = now
+            line_channel_misses.move_to_end(bot_id)
+            while len(line_channel_misses) > LINE_CHANNEL_MISS_CACHE_SIZE:
+                line_channel_misses.popitem(last=False)
+        if channel:
+            channel.api_client.close()
+        return None
+    if channel and channel.credentials == (doc['channel_secret'], doc['channel_access_token']):
+        with line_channels_lock:
+            line_channels[bot_id] = (channel, time.monotonic())
+        return channel
+    stale = channel
+    channel = LineChannel(bot_id, doc['channel_secret'], doc['channel_access_token'])
+    with line_channels_lock:
+        line_channels[bot_id] = (channel, time.monotonic())
+        line_channel_misses.pop(bot_id, None)
+    if stale:
+        stale.api_client.close()
+    return channel
+
+
+def get_api_client():
+    return g.line_channel.api_client
+
+
+@blueprint.route('/', methods=['GET'])
 def test():
     return 'OK'
 
 
-@application.route('/data/line/<path:filename>', methods=['GET'])
+@blueprint.route('/data/line/<path:filename>', methods=['GET'])
 def serve_file(filename):
     try:
         return send_from_directory(LINE_DIR, filename, as_attachment=False)
@@ -71,71 +168,92 @@ def serve_file(filename):
         abort(404, description='File not found')
 
 
-@application.route('/line', methods=['GET'])
+@blueprint.route('/line', methods=['GET'])
 def serve_html():
     return send_from_directory(STATIC_DIR, 'line.html')
 
 
-@application.route('/callback', methods=['POST'])
+@blueprint.route('/callback', methods=['POST'])
 def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
     print('[callback] Request body: ' + body)
     try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
-        print('[callback] Invalid signature. Please check your channel access token/channel secret.')
+        payload = json.loads(body)
+    except ValueError:
+        abort(400)
+    if not isinstance(payload, dict):
+        abort(400)
+    destination = payload.get('destination')
+    channel = (get_channel(destination) if destination else None) or get_default_channel()
+    if channel is None or not channel.validate(body, signature):
+        print(f'[callback] Invalid signature for destination {destination}. '
+              'Please check your channel access token/channel secret.')
         abort(400)
+    g.line_channel = channel
+    get_handler().handle(body, signature)
     return 'OK'
 
 
-@application.route('/api/send', methods=['POST'])
+@blueprint.route('/api/send', methods=['POST'])
 def send():
     data = request.get_json(silent=True) or {}
     to = data.get('to')
     text = data.get('text')
     if not to or not text:
         return {'error': "Parameter 'to' and 'text' are required."}, 400
+    bot_id = data.get('bot_id')
+    channel = get_channel(bot_id) if bot_id else get_default_channel()
+    if channel is None:
+        return {'error': 'Unknown bot_id.'}, 400
+    from linebot.v3.messaging import TextMessage
+    from linebot.v3.messaging import MessagingApi
+    from linebot.v3.messaging import PushMessageRequest
     try:
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).push_message_with_http_info(
-                PushMessageRequest(
-                    to=to,
-                    messages=[TextMessage(text=text)]
-                )
+        MessagingApi(channel.api_client).push_message_with_http_info(
+            PushMessageRequest(
+                to=to,
+                messages=[TextMessage(text=text)]
             )
+        )
     except Exception as e:
         print(f'[send] failed: {e}')
         abort(500)
     return 'OK'
 
 
-@application.route('/api/broadcast', methods=['POST'])
+@blueprint.route('/api/broadcast', methods=['POST'])
 def broadcast():
     data = request.get_json(silent=True) or {}
     text = data.get('text')
     if not text:
         return {'error': 'text required'}, 400
+    bot_id = data.get('bot_id')
+    channel = get_channel(bot_id) if bot_id else get_default_channel()
+    if channel is None:
+        return {'error': 'Unknown bot_id.'}, 400
+    from linebot.v3.messaging import TextMessage
+    from linebot.v3.messaging import MessagingApi
+    from linebot.v3.messaging import BroadcastRequest
     try:
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).broadcast(
-                BroadcastRequest(
-                    messages=[TextMessage(text=text)]
-                )
+        MessagingApi(channel.api_client).broadcast(
+            BroadcastRequest(
+                messages=[TextMessage(text=text)]
             )
+        )
     except Exception as e:
         print(f'[broadcast] failed: {e}')
         abort(500)
     return 'OK'
 
 
-@application.route('/api/bots', methods=['GET'])
+@blueprint.route('/api/bots', methods=['GET'])
 def get_bots():
     bot_ids = message_collection.distinct('bot_id')
     return jsonify(bot_ids)
 
 
-@application.route('/api/sources', methods=['GET'])
+@blueprint.route('/api/sources', methods=['GET'])
 def get_sources():
     sources = []
     for user in user_collection.find():
@@ -159,7 +277,7 @@ def get_sources():
     return jsonify(sources)
 
 
-@application.route('/api/messages', methods=['GET'])
+@blueprint.route('/api/messages', methods=['GET'])
 def get_messages():
     bot_id = request.args.get('bot_id')
     source_type = request.args.get('source_type')
@@ -179,104 +297,133 @@ def get_messages():
         }
     else:
         return {'error': "Parameter 'source_id' or 'user_id' is required."}, 400
-    messages = []
-    cursor = message_collection.find(query).sort('created_at', 1)
-    for row in cursor:
-        user_id = row.get('user_id', '')
-        user = user_collection.find_one({'user_id': user_id})
-        messages.append({
+    cursor = message_collection.find(query, MESSAGE_PROJECTION).sort('created_at', 1).batch_size(BATCH_SIZE)
+    return json_stream_response(message_batches(cursor))
+
+
+def message_batches(cursor):
+    user_names = {}
+    for rows in iter_batches(cursor):
+        user_ids = {row.get('user_id', '') for row in rows} - user_names.keys()
+        user_names.update({user_id: user_id for user_id in user_ids})
+        for user in user_collection.find({'user_id': {'$in': list(user_ids)}}):
+            user_names[user['user_id']] = user.get('display_name')
+        timestamps = format_timestamps(rows)
+        yield [{
             'type': row.get('message_type'),
             'content': row.get('message_content'),
             'user_id': row.get('user_id'),
-            'user_name': user.get('display_name') if user else user_id,
-            'timestamp': row.get('created_at').strftime('%Y-%m-%d %H:%M:%S')
-        })
-    return jsonify(messages)
+            'user_name': user_names[row.get('user_id', '')],
+            'timestamp': timestamp
+        } for row, timestamp in zip(rows, timestamps)]
+
+
+@blueprint.route('/api/stats/<group_by>', methods=['GET'])
+def get_stats(group_by):
+    try:
+        group_by, granularity, start, end = parse_stats_args(group_by, request.args)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    filters = {
+        'bot_id': request.args.get('bot_id'),
+        'source_type': request.args.get('source_type'),
+        'source_id': request.args.get('source_id'),
+        'user_id': request.args.get('user_id'),
+        'message_type': request.args.get('message_type')
+    }
+    return jsonify(query_rollups(
+        rollup_collection, ROLLUP_FIELDS, group_by, granularity, filters, start, end, peer_field='user_id'
+    ))
 
 
-@handler.add(JoinEvent)
 def handle_member_joined(event):
-    with ApiClient(configuration) as api_client:
-        line_api = MessagingApi(api_client)
-        source_type = event.source.type
-        if source_type == 'group':
-            group_id = event.source.group_id
-            print(f'[handle_member_joined] group_id: {group_id}')
-            group_exists = group_collection.find_one({'group_id': group_id})
-            if not group_exists:
-                line_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text='Please set a name for this group by typing: /setname YourGroupName')]
-                    )
+    from linebot.v3.messaging import TextMessage
+    from linebot.v3.messaging import MessagingApi
+    from linebot.v3.messaging import ReplyMessageRequest
+    line_api = MessagingApi(get_api_client())
+    source_type = event.source.type
+    if source_type == 'group':
+        group_id = event.source.group_id
+        print(f'[handle_member_joined] group_id: {group_id}')
+        group_exists = group_collection.find_one({'group_id': group_id})
+        if not group_exists:
+            line_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text='Please set a name for this group by typing: /setname YourGroupName')]
                 )
-        elif source_type == 'room':
-            room_id = event.source.room_id
-            print(f'[handle_member_joined] room_id: {room_id}')
-            room_exists = room_collection.find_one({'room_id': room_id})
-            if not room_exists:
-                line_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text='Please set a name for this room by typing: /setname YourRoomName')]
-                    )
+            )
+    elif source_type == 'room':
+        room_id = event.source.room_id
+        print(f'[handle_member_joined] room_id: {room_id}')
+        room_exists = room_collection.find_one({'room_id': room_id})
+        if not room_exists:
+            line_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text='Please set a name for this room by typing: /setname YourRoomName')]
                 )
+            )
 
 
-@handler.add(MessageEvent, message=TextMessageContent)
 def handle_text_message(event):
-    with ApiClient(configuration) as api_client:
-        line_api = MessagingApi(api_client)
-        source_type = event.source.type
-        if source_type == 'group':
-            group_id = event.source.group_id
-            user_id = event.source.user_id
-            print(f'[handle_text_message] user_id: {user_id}, group_id: {group_id}')
-            if event.message.text.startswith('/setname'):
-                group_name = event.message.text.replace('/setname', '').strip()
-                upsert_group(group_id, group_name)
-                line_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=f'Group name has been set to: {group_name}')]
-                    )
+    from linebot.v3.messaging import TextMessage
+    from linebot.v3.messaging import MessagingApi
+    from linebot.v3.messaging import ReplyMessageRequest
+    line_api = MessagingApi(get_api_client())
+    source_type = event.source.type
+    if source_type == 'group':
+        group_id = event.source.group_id
+        user_id = event.source.user_id
+        print(f'[handle_text_message] user_id: {user_id}, group_id: {group_id}')
+        if event.message.text.startswith('/setname'):
+            group_name = event.message.text.replace('/setname', '').strip()
+            upsert_group(group_id, group_name)
+            line_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text=f'Group name has been set to: {group_name}')]
                 )
-            else:
-                bot_id = request.json['destination']
-                message_text = event.message.text
-                timestamp = event.timestamp
-                insert_message(bot_id, 'text', message_text, source_type, group_id, user_id, timestamp)
-        elif source_type == 'room':
-            room_id = event.source.room_id
-            user_id = event.source.user_id
-            print(f'[handle_text_message] user_id: {user_id}, room_id: {room_id}')
-            if event.message.text.startswith('/setname'):
-                room_name = event.message.text.replace('/setname', '').strip()
-                upsert_room(room_id, room_name)
-                line_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=f'Room name has been set to: {room_name}')]
-                    )
+            )
+        else:
+            bot_id = request.json['destination']
+            message_text = event.message.text
+            timestamp = event.timestamp
+            insert_message(bot_id, 'text', message_text, source_type, group_id, user_id, timestamp)
+    elif source_type == 'room':
+        room_id = event.source.room_id
+        user_id = event.source.user_id
+        print(f'[handle_text_message] user_id: {user_id}, room_id: {room_id}')
+        if event.message.text.startswith('/setname'):
+            room_name = event.message.text.replace('/setname', '').strip()
+            upsert_room(room_id, room_name)
+            line_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text=f'Room name has been set to: {room_name}')]
                 )
-            else:
-                bot_id = request.json['destination']
-                message_text = event.message.text
-                timestamp = event.timestamp
-                insert_message(bot_id, 'text', message_text, source_type, room_id, user_id, timestamp)
-        elif source_type == 'user':
-            user_id = event.source.user_id
-            print(f'[handle_text_message] user_id: {user_id}')
-            profile = line_api.get_profile(user_id)
-            upsert_user(user_id, profile.display_name)
+            )
+        else:
             bot_id = request.json['destination']
             message_text = event.message.text
             timestamp = event.timestamp
-            insert_message(bot_id, 'text', message_text, source_type, None, user_id, timestamp)
+            insert_message(bot_id, 'text', message_text, source_type, room_id, user_id, timestamp)
+    elif source_type == 'user':
+        user_id = event.source.user_id
+        print(f'[handle_text_message] user_id: {user_id}')
+        profile = line_api.get_profile(user_id)
+        upsert_user(user_id, profile.display_name)
+        bot_id = request.json['destination']
+        message_text = event.message.text
+        timestamp = event.timestamp
+        insert_message(bot_id, 'text', message_text, source_type, None, user_id, timestamp)
 
 
-@handler.add(MessageEvent, message=(ImageMessageContent, VideoMessageContent, AudioMessageContent))
 def handle_content_message(event):
+    from linebot.v3.messaging import MessagingApiBlob
+    from linebot.v3.webhooks import ImageMessageContent
+    from linebot.v3.webhooks import VideoMessageContent
+    from linebot.v3.webhooks import AudioMessageContent
     if isinstance(event.message, ImageMessageContent):
         ext = 'jpg'
     elif isinstance(event.message, VideoMessageContent):
@@ -285,29 +432,29 @@ def handle_content_message(event):
         ext = 'm4a'
     else:
         return
-    with ApiClient(configuration) as api_client:
-        line_bot_blob_api = MessagingApiBlob(api_client)
-        content = line_bot_blob_api.get_message_content(event.message.id)
-        file_name = f'{uuid.uuid4().hex}.{ext}'
-        with open(os.path.join(LINE_DIR, file_name), 'wb') as f:
-            f.write(content)
-        bot_id = request.json['destination']
-        source_type = event.source.type
-        timestamp = event.timestamp
-        if source_type == 'group':
-            group_id = event.source.group_id
-            user_id = event.source.user_id
-            print(f'[handle_content_message] user_id: {user_id}, group_id: {group_id}')
-            insert_message(bot_id, ext, file_name, source_type, group_id, user_id, timestamp)
-        elif source_type == 'room':
-            room_id = event.source.room_id
-            user_id = event.source.user_id
-            print(f'[handle_content_message] user_id: {user_id}, room_id: {room_id}')
-            insert_message(bot_id, ext, file_name, source_type, room_id, user_id, timestamp)
-        elif source_type == 'user':
-            user_id = event.source.user_id
-            print(f'[handle_content_message] user_id: {user_id}')
-            insert_message(bot_id, ext, file_name, source_type, None, user_id, timestamp)
+    line_bot_blob_api = MessagingApiBlob(get_api_client())
+    content = line_bot_blob_api.get_message_content(event.message.id)
+    file_name = f'{uuid.uuid4().hex}.{ext}'
+    os.makedirs(LINE_DIR, exist_ok=True)
+    with open(os.path.join(LINE_DIR, file_name), 'wb') as f:
+        f.write(content)
+    bot_id = request.json['destination']
+    source_type = event.source.type
+    timestamp = event.timestamp
+    if source_type == 'group':
+        group_id = event.source.group_id
+        user_id = event.source.user_id
+        print(f'[handle_content_message] user_id: {user_id}, group_id: {group_id}')
+        insert_message(bot_id, ext, file_name, source_type, group_id, user_id, timestamp)
+    elif source_type == 'room':
+        room_id = event.source.room_id
+        user_id = event.source.user_id
+        print(f'[handle_content_message] user_id: {user_id}, room_id: {room_id}')
+        insert_message(bot_id, ext, file_name, source_type, room_id, user_id, timestamp)
+    elif source_type == 'user':
+        user_id = event.source.user_id
+        print(f'[handle_content_message] user_id: {user_id}')
+        insert_message(bot_id, ext, file_name, source_type, None, user_id, timestamp)
 
 
 def upsert_user(user_id, display_name):
@@ -373,7 +520,23 @@ def insert_message(bot_id, message_type, message_content, source_type, source_id
         'updated_at': datetime.fromtimestamp(timestamp / 1000)
     }
     message_collection.insert_one(message_doc)
+    increment_rollups(rollup_collection, ROLLUP_FIELDS, [message_doc])
+
+
+def create_app():
+    app = Flask(__name__)
+    app.config['CORS_HEADERS'] = 'Content-Type'
+    app.config['CORS_RESOURCES'] = {r'/api/*': {'origins': '*'}}
+    app.config['PROPAGATE_EXCEPTIONS'] = True
+    app.register_blueprint(blueprint)
+    return app
+
+
+application = create_app()
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'rebuild-stats':
+        rebuild_rollups(message_collection, rollup_collection, ROLLUP_FIELDS)
+        sys.exit(0)
     application.run(host='0.0.0.0', port=5050)
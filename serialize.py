@@ -0,0 +1,77 @@
+import zlib
+import orjson
+
+from flask import request
+from flask import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+BATCH_SIZE = 1000
+
+
+def iter_batches(cursor, batch_size=BATCH_SIZE):
+    batch = []
+    for row in cursor:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def format_timestamps(rows, field='created_at'):
+    # isoformat() on naive datetimes gives the same text as strftime('%Y-%m-%d %H:%M:%S') at a fraction of the cost
+    return [row[field].isoformat(' ', 'seconds') if row.get(field) else None for row in rows]
+
+
+def stream_json_array(batches):
+    first = True
+    yield b'['
+    for items in batches:
+        if not items:
+            continue
+        chunk = orjson.dumps(items)[1:-1]
+        yield chunk if first else b',' + chunk
+        first = False
+    yield b']'
+
+
+def compress_stream(chunks, encoding):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=4)
+        for chunk in chunks:
+            data = compressor.process(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+    elif encoding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    else:
+        yield from chunks
+
+
+def negotiate_encoding(accept_encodings):
+    if brotli is not None and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def json_stream_response(batches):
+    encoding = negotiate_encoding(request.accept_encodings)
+    response = Response(compress_stream(stream_json_array(batches), encoding), mimetype='application/json')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
@@ -0,0 +1,137 @@
+import threading
+
+from datetime import datetime
+
+
+GRANULARITIES = ('hour', 'day')
+
+GROUP_BY = {
+    'sources': ('source_type', 'source_id'),
+    'users': ('user_id',),
+    'types': ('message_type',),
+    'timeline': ('bucket',)
+}
+
+
+def truncate(timestamp, granularity):
+    if granularity == 'hour':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+indexed_collections = set()
+indexed_collections_lock = threading.Lock()
+
+
+def ensure_rollup_indexes(rollup_collection, fields):
+    with indexed_collections_lock:
+        if rollup_collection.full_name in indexed_collections:
+            return
+        rollup_collection.create_index(
+            [('granularity', 1), ('bucket', 1)] + [(field, 1) for field in fields],
+            unique=True
+        )
+        indexed_collections.add(rollup_collection.full_name)
+
+
+def increment_rollups(rollup_collection, fields, message_docs):
+    counts = {}
+    for doc in message_docs:
+        for granularity in GRANULARITIES:
+            key = (granularity, truncate(doc['created_at'], granularity)) + tuple(doc.get(f) for f in fields)
+            counts[key] = counts.get(key, 0) + 1
+    if not counts:
+        return
+    ensure_rollup_indexes(rollup_collection, fields)
+    from pymongo import UpdateOne
+    now = datetime.now()
+    operations = []
+    for key, count in counts.items():
+        rollup_key = dict(zip(('granularity', 'bucket') + tuple(fields), key))
+        operations.append(UpdateOne(
+            rollup_key,
+            {
+                '$inc': {'count': count},
+                '$set': {'updated_at': now}
+            },
+            upsert=True
+        ))
+    rollup_collection.bulk_write(operations, ordered=False)
+
+
+def rebuild_rollups(message_collection, rollup_collection, fields):
+    rollup_collection.delete_many({})
+    ensure_rollup_indexes(rollup_collection, fields)
+    now = datetime.now()
+    for granularity in GRANULARITIES:
+        message_collection.aggregate([
+            {'$group': {
+                '_id': {
+                    'bucket': {'$dateTrunc': {'date': '$created_at', 'unit': granularity}},
+                    **{field: f'${field}' for field in fields}
+                },
+                'count': {'$sum': 1}
+            }},
+            {'$replaceWith': {'$mergeObjects': ['$_id', {'granularity': granularity, 'count': '$count'}]}},
+            {'$set': {'updated_at': now}},
+            {'$merge': {'into': rollup_collection.name}}
+        ], allowDiskUse=True)
+    print(f'[rebuild_rollups] {rollup_collection.count_documents({})} rollup documents')
+
+
+def query_rollups(rollup_collection, fields, group_by, granularity, filters, start=None, end=None, peer_field=None):
+    # peer_field holds the other party of 1:1 chats, which have no source_id
+    ensure_rollup_indexes(rollup_collection, fields)
+    match = {'granularity': granularity}
+    match.update({k: v for k, v in filters.items() if v is not None})
+    if start or end:
+        match['bucket'] = {}
+        if start:
+            match['bucket']['$gte'] = start
+        if end:
+            match['bucket']['$lt'] = end
+    keys = GROUP_BY[group_by]
+    group_id = {key: f'${key}' for key in keys}
+    if peer_field and 'source_id' in group_id:
+        group_id['source_id'] = {'$ifNull': ['$source_id', f'${peer_field}']}
+    cursor = rollup_collection.aggregate([
+        {'$match': match},
+        {'$group': {'_id': group_id, 'count': {'$sum': '$count'}}},
+        {'$sort': {f'_id.{key}': 1 for key in keys} if group_by == 'timeline' else {'count': -1}}
+    ])
+    results = []
+    for row in cursor:
+        result = dict(row['_id'])
+        if 'bucket' in result:
+            result['bucket'] = result['bucket'].strftime('%Y-%m-%d %H:%M:%S')
+        result['count'] = row['count']
+        results.append(result)
+    return results
+
+
+def parse_stats_args(group_by, args):
+    if group_by not in GROUP_BY:
+        raise ValueError(f"Stats must be one of: {', '.join(GROUP_BY)}.")
+    granularity = args.get('granularity', 'day')
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"Parameter 'granularity' must be one of: {', '.join(GRANULARITIES)}.")
+    # start is inclusive and end exclusive; both must fall on bucket boundaries
+    bounds = []
+    for name in ('start', 'end'):
+        value = args.get(name)
+        value = datetime.fromisoformat(value) if value else None
+        if value and truncate(value, granularity) != value:
+            raise ValueError(f"Parameter '{name}' must be aligned to the {granularity}.")
+        bounds.append(value)
+    return group_by, granularity, bounds[0], bounds[1]
+
+
+def parse_int_args(args, names):
+    values = {}
+    for name in names:
+        value = args.get(name)
+        try:
+            values[name] = int(value) if value else None
+        except ValueError:
+            raise ValueError(f"Parameter '{name}' must be an integer.")
+    return values
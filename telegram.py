@@ -1,20 +1,34 @@
 import os
+import sys
+import time
 import uuid
 import asyncio
 import mimetypes
 import threading
 
+from typing import TYPE_CHECKING
 from flask import abort
 from flask import Flask
 from flask import jsonify
 from flask import request
+from flask import Blueprint
 from flask import send_from_directory
 from datetime import datetime
+from datetime import timedelta
 from dotenv import load_dotenv
-from pymongo import MongoClient
-from telethon import events
-from telethon import TelegramClient
-from telethon.tl import types as tl
+from lazy import LazyCollection
+from serialize import BATCH_SIZE
+from serialize import iter_batches
+from serialize import format_timestamps
+from serialize import json_stream_response
+from stats import query_rollups
+from stats import rebuild_rollups
+from stats import parse_int_args
+from stats import parse_stats_args
+from stats import increment_rollups
+
+if TYPE_CHECKING:
+    from telethon.tl import types as tl
 
 
 load_dotenv()
@@ -25,45 +39,68 @@ TELEGRAM_API_ID = os.getenv('TELEGRAM_API_ID')
 TELEGRAM_API_HASH = os.getenv('TELEGRAM_API_HASH')
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 
+BACKFILL_CONCURRENCY = 8
+BACKFILL_BATCH_SIZE = 100
+BACKFILL_REQUESTS_PER_SECOND = 5
+# Listener timestamps are taken on receipt, so allow for a little delay when matching them to history
+BACKFILL_LEGACY_SLACK = timedelta(minutes=1)
+
 STATIC_DIR = os.path.join(os.path.dirname(__file__), os.getenv('STATIC_DIR'))
 
-application = Flask(__name__)
-application.config['CORS_HEADERS'] = 'Content-Type'
-application.config['CORS_RESOURCES'] = {r'/api/*': {'origins': '*'}}
-application.config['PROPAGATE_EXCEPTIONS'] = True
+blueprint = Blueprint('telegram', __name__)
 
-mongo_client = MongoClient('localhost', 27017)
-telegram_db = mongo_client['telegram']
-message_collection = telegram_db['message']
-user_collection = telegram_db['user']
-chat_collection = telegram_db['chat']
-channel_collection = telegram_db['channel']
+message_collection = LazyCollection('telegram', 'message')
+user_collection = LazyCollection('telegram', 'user')
+chat_collection = LazyCollection('telegram', 'chat')
+channel_collection = LazyCollection('telegram', 'channel')
+backfill_collection = LazyCollection('telegram', 'backfill')
+rollup_collection = LazyCollection('telegram', 'message_rollup')
 
-os.makedirs(TELEGRAM_DIR, exist_ok=True)
+ROLLUP_FIELDS = ('bot_id', 'source_type', 'source_id', 'user_id', 'target_id', 'message_type')
+MESSAGE_PROJECTION = {
+    '_id': 0, 'message_type': 1, 'message_content': 1, 'user_id': 1, 'target_id': 1, 'created_at': 1
+}
 
 USER_SESSION_DIR = os.path.join(TELEGRAM_DIR, 'user_session')
 BOT_SESSION_DIR = os.path.join(TELEGRAM_DIR, 'bot_session')
 
-user_client = TelegramClient(USER_SESSION_DIR, int(TELEGRAM_API_ID), TELEGRAM_API_HASH)
-bot_client = TelegramClient(BOT_SESSION_DIR, int(TELEGRAM_API_ID), TELEGRAM_API_HASH)
+user_client = None
+bot_client = None
+clients_lock = threading.Lock()
 
 bot_id = None
+user_account_id = None
 telegram_loop = None
 
 
-@user_client.on(events.NewMessage())
+def get_clients():
+    global user_client, bot_client
+    if bot_client is None:
+        with clients_lock:
+            if bot_client is None:
+                from telethon import events
+                from telethon import TelegramClient
+                os.makedirs(TELEGRAM_DIR, exist_ok=True)
+                user_client = TelegramClient(USER_SESSION_DIR, int(TELEGRAM_API_ID), TELEGRAM_API_HASH)
+                user_client.add_event_handler(handle_user_message, events.NewMessage())
+                client = TelegramClient(BOT_SESSION_DIR, int(TELEGRAM_API_ID), TELEGRAM_API_HASH)
+                client.add_event_handler(handle_bot_message, events.NewMessage())
+                bot_client = client
+    return user_client, bot_client
+
+
 async def handle_user_message(event):
     print(f'handle_user_message')
     await _common_handler(event, user_client)
 
 
-@bot_client.on(events.NewMessage())
 async def handle_bot_message(event):
     print(f'handle_bot_message')
     await _common_handler(event, bot_client)
 
 
 async def _common_handler(event, client):
+    from telethon.tl import types as tl
     sender = await event.get_sender()
     user_id = None
     target_id = None
@@ -107,12 +144,13 @@ async def _common_handler(event, client):
     message = event.message
     print(f'[_common_handler] message: {message}')
     timestamp = datetime.now()
+    origin = (bot_id if client is bot_client else user_account_id, message.chat_id, message.id)
     if message.message:
-        insert_message('text', message.message, tag, source_id, user_id, target_id, timestamp)
+        insert_message('text', message.message, tag, source_id, user_id, target_id, timestamp, origin)
     if any((message.photo, message.video, message.document, message.voice, message.audio)):
         file_name, mtype = await save_media(message)
         print(f'[_common_handler] file_name: {file_name}, mtype: {mtype}')
-        insert_message(mtype, file_name, tag, source_id, user_id, target_id, timestamp)
+        insert_message(mtype, file_name, tag, source_id, user_id, target_id, timestamp, origin)
 
 
 async def save_media(message):
@@ -121,6 +159,7 @@ async def save_media(message):
     mime = message.file.mime_type or ''
     ext = mimetypes.guess_extension(mime) or '.bin'
     file_name = f'{uuid.uuid4().hex}{ext}'
+    os.makedirs(TELEGRAM_DIR, exist_ok=True)
     await message.download_media(file=os.path.join(TELEGRAM_DIR, file_name))
     if message.photo:
         return file_name, 'photo'
@@ -131,7 +170,7 @@ async def save_media(message):
     return file_name, 'document'
 
 
-def upsert_user(user: tl.User):
+def upsert_user(user: 'tl.User'):
     timestamp = datetime.now()
     user_collection.update_one(
         {'user_id': user.id},
@@ -152,7 +191,7 @@ def upsert_user(user: tl.User):
     )
 
 
-def upsert_chat(chat: tl.Chat):
+def upsert_chat(chat: 'tl.Chat'):
     timestamp = datetime.now()
     chat_collection.update_one(
         {'chat_id': chat.id},
@@ -169,7 +208,7 @@ def upsert_chat(chat: tl.Chat):
     )
 
 
-def upsert_channel(channel: tl.Channel):
+def upsert_channel(channel: 'tl.Channel'):
     timestamp = datetime.now()
     channel_collection.update_one(
         {'channel_id': channel.id},
@@ -187,9 +226,14 @@ def upsert_channel(channel: tl.Channel):
     )
 
 
-def insert_message(message_type, message_content, source_type, source_id, user_id, target_id, timestamp):
-    message_doc = {
+def build_message_doc(message_type, message_content, source_type, source_id, user_id, target_id, timestamp, origin):
+    # origin is (account_id, dialog_id, message_id); Telegram message ids are only unique per observing account
+    account_id, dialog_id, message_id = origin
+    return {
         'bot_id': bot_id,
+        'account_id': account_id,
+        'dialog_id': dialog_id,
+        'message_id': message_id,
         'message_type': message_type,
         'message_content': message_content,
         'source_type': source_type,
@@ -199,15 +243,248 @@ def insert_message(message_type, message_content, source_type, source_id, user_i
         'created_at': timestamp,
         'updated_at': timestamp
     }
-    message_collection.insert_one(message_doc)
+
+
+def ensure_message_indexes():
+    message_collection.create_index(
+        [('account_id', 1), ('dialog_id', 1), ('message_id', 1), ('message_type', 1)],
+        unique=True,
+        partialFilterExpression={'message_id': {'$exists': True}}
+    )
+
+
+def insert_message(message_type, message_content, source_type, source_id, user_id, target_id, timestamp, origin):
+    from pymongo.errors import DuplicateKeyError
+    message_doc = build_message_doc(
+        message_type, message_content, source_type, source_id, user_id, target_id, timestamp, origin
+    )
+    try:
+        message_collection.insert_one(message_doc)
+    except DuplicateKeyError:
+        print(f'[insert_message] duplicate message skipped: {origin}')
+        return
+    increment_rollups(rollup_collection, ROLLUP_FIELDS, [message_doc])
+
+
+def insert_messages(message_docs):
+    from pymongo.errors import BulkWriteError
+    if not message_docs:
+        return 0
+    try:
+        message_collection.insert_many(message_docs, ordered=False)
+        inserted = message_docs
+    except BulkWriteError as e:
+        errors = e.details.get('writeErrors', [])
+        if any(error['code'] != 11000 for error in errors):
+            raise
+        duplicates = {error['index'] for error in errors}
+        inserted = [doc for i, doc in enumerate(message_docs) if i not in duplicates]
+    increment_rollups(rollup_collection, ROLLUP_FIELDS, inserted)
+    return len(inserted)
+
+
+class RateLimiter:
+    """Spaces out requests shared by all backfill tasks and pauses them all on FloodWait."""
+
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second
+        self.next_time = 0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            if self.next_time > now:
+                await asyncio.sleep(self.next_time - now)
+            self.next_time = max(now, self.next_time) + self.interval
+
+    def pause(self, seconds):
+        self.next_time = max(self.next_time, time.monotonic() + seconds)
+
+    async def call(self, request):
+        from telethon.errors import FloodWaitError
+        while True:
+            await self.wait()
+            try:
+                return await request()
+            except FloodWaitError as e:
+                print(f'[RateLimiter] FloodWait {e.seconds}s')
+                self.pause(e.seconds)
+
+
+def media_type(message):
+    if message.photo:
+        return 'photo'
+    if message.video:
+        return 'video'
+    if message.voice or message.audio:
+        return 'audio'
+    if message.document:
+        return 'document'
+    return None
+
+
+def history_message_docs(message, tag, source_id, target_id):
+    from telethon.tl import types as tl
+    sender = message.sender
+    user_id = None
+    if isinstance(sender, tl.User):
+        user_id = sender.id
+    timestamp = message.date.astimezone().replace(tzinfo=None)
+    origin = (user_account_id, message.chat_id, message.id)
+    docs = []
+    if message.message:
+        docs.append(build_message_doc('text', message.message, tag, source_id, user_id, target_id, timestamp, origin))
+    mtype = media_type(message)
+    if mtype:
+        doc = build_message_doc(mtype, '', tag, source_id, user_id, target_id, timestamp, origin)
+        doc['media_pending'] = True
+        docs.append(doc)
+    return docs
+
+
+def legacy_window(tag, source_id, target_id):
+    # Documents stored by the listener before message ids were recorded cannot be matched by key, so
+    # history inside the span they cover is assumed to be captured already and skipped.
+    query = {
+        'message_id': {'$exists': False},
+        'source_type': tag,
+        'source_id': source_id,
+        'target_id': target_id
+    }
+    oldest = message_collection.find_one(query, {'created_at': 1}, sort=[('created_at', 1)])
+    if not oldest:
+        return None
+    newest = message_collection.find_one(query, {'created_at': 1}, sort=[('created_at', -1)])
+    return oldest['created_at'] - BACKFILL_LEGACY_SLACK, newest['created_at']
+
+
+async def backfill_dialog(client, dialog, limiter):
+    from telethon.tl import types as tl
+    entity = dialog.entity
+    if isinstance(entity, tl.User):
+        upsert_user(entity)
+        tag, source_id, target_id = 'private', None, entity.id
+    elif isinstance(entity, tl.Chat):
+        upsert_chat(entity)
+        tag, source_id, target_id = 'group', entity.id, None
+    elif isinstance(entity, tl.Channel):
+        upsert_channel(entity)
+        tag, source_id, target_id = 'channel', entity.id, None
+    else:
+        return 0
+    checkpoint = backfill_collection.find_one({'dialog_id': dialog.id}) or {}
+    last_message_id = checkpoint.get('last_message_id', 0)
+    window = legacy_window(tag, source_id, target_id)
+    count = 0
+    while True:
+        batch = await limiter.call(lambda: collect_messages(client, entity, last_message_id))
+        if not batch:
+            break
+        users = {}
+        docs = []
+        for message in batch:
+            if isinstance(message, tl.MessageService):
+                continue
+            if isinstance(message.sender, tl.User):
+                users[message.sender.id] = message.sender
+            docs.extend(history_message_docs(message, tag, source_id, target_id))
+        if window:
+            docs = [doc for doc in docs if not window[0] <= doc['created_at'] <= window[1]]
+        for user in users.values():
+            upsert_user(user)
+        inserted = insert_messages(docs)
+        last_message_id = batch[-1].id
+        backfill_collection.update_one(
+            {'dialog_id': dialog.id},
+            {
+                '$set': {
+                    'last_message_id': last_message_id,
+                    'updated_at': datetime.now()
+                }
+            },
+            upsert=True
+        )
+        count += len(batch)
+        if inserted < len(docs):
+            print(f'[backfill_dialog] {dialog.name}: skipped {len(docs) - inserted} already stored')
+        if len(batch) < BACKFILL_BATCH_SIZE:
+            break
+    print(f'[backfill_dialog] {dialog.name}: {count} messages, last_message_id={last_message_id}')
+    return count
+
+
+async def collect_messages(client, entity, min_id):
+    return [m async for m in client.iter_messages(entity, limit=BACKFILL_BATCH_SIZE, min_id=min_id, reverse=True)]
+
+
+async def backfill_media(client, limiter):
+    count = 0
+    # Load the pending rows up front so no cursor sits idle across slow downloads
+    rows = list(message_collection.find(
+        {'media_pending': {'$exists': True}, 'message_id': {'$exists': True}},
+        {'_id': 1, 'dialog_id': 1, 'message_id': 1}
+    ))
+    for row in rows:
+        try:
+            message = await limiter.call(lambda: client.get_messages(row['dialog_id'], ids=row['message_id']))
+            if message is None:
+                continue
+            file_name, _ = await limiter.call(lambda: save_media(message))
+        except Exception as e:
+            print(f'[backfill_media] {row["dialog_id"]}/{row["message_id"]} failed: {e}')
+            continue
+        message_collection.update_one(
+            {'_id': row['_id']},
+            {
+                '$set': {'message_content': file_name},
+                '$unset': {'media_pending': ''}
+            }
+        )
+        count += 1
+    print(f'[backfill_media] downloaded {count} files')
+
+
+async def backfill(download_media=False):
+    global bot_id, user_account_id
+    user_client, bot_client = get_clients()
+    await user_client.start()
+    await bot_client.start(bot_token=TELEGRAM_BOT_TOKEN)
+    bot_id = (await bot_client.get_me()).id
+    user_account_id = (await user_client.get_me()).id
+    ensure_message_indexes()
+    user_client.flood_sleep_threshold = 0
+    limiter = RateLimiter(BACKFILL_REQUESTS_PER_SECOND)
+    semaphore = asyncio.Semaphore(BACKFILL_CONCURRENCY)
+
+    async def run(dialog):
+        async with semaphore:
+            try:
+                return await backfill_dialog(user_client, dialog, limiter)
+            except Exception as e:
+                print(f'[backfill] {dialog.name} ({dialog.id}) failed: {e}')
+                return 0
+
+    start = time.perf_counter()
+    dialogs = await limiter.call(user_client.get_dialogs)
+    counts = await asyncio.gather(*(run(d) for d in dialogs))
+    elapsed = time.perf_counter() - start
+    total = sum(counts)
+    print(f'[backfill] {total} messages from {len(dialogs)} dialogs in {elapsed:.1f}s '
+          f'({total / elapsed if elapsed else 0:.1f} messages/sec)')
+    if download_media:
+        await backfill_media(user_client, limiter)
 
 
 async def bootstrap():
-    global bot_id, telegram_loop
+    global bot_id, user_account_id, telegram_loop
+    user_client, bot_client = get_clients()
     await user_client.start()
     await bot_client.start(bot_token=TELEGRAM_BOT_TOKEN)
     print('>>> Start Listening ...')
     bot_id = (await bot_client.get_me()).id
+    user_account_id = (await user_client.get_me()).id
+    ensure_message_indexes()
     telegram_loop = asyncio.get_running_loop()
     print(f'[bootstrap] Bot started. bot_id={bot_id}')
     await asyncio.gather(
@@ -220,12 +497,12 @@ def start_telethon_loop():
     asyncio.run(bootstrap())
 
 
-@application.route('/', methods=['GET'])
+@blueprint.route('/', methods=['GET'])
 def test():
     return 'OK'
 
 
-@application.route('/data/telegram/<path:filename>', methods=['GET'])
+@blueprint.route('/data/telegram/<path:filename>', methods=['GET'])
 def serve_file(filename):
     try:
         return send_from_directory(TELEGRAM_DIR, filename, as_attachment=False)
@@ -233,12 +510,12 @@ def serve_file(filename):
         abort(404, description='File not found')
 
 
-@application.route('/telegram', methods=['GET'])
+@blueprint.route('/telegram', methods=['GET'])
 def serve_html():
     return send_from_directory(STATIC_DIR, 'telegram.html')
 
 
-@application.route('/api/sources', methods=['GET'])
+@blueprint.route('/api/sources', methods=['GET'])
 def get_sources():
     sources = []
     for user in user_collection.find({'is_self': False}):
@@ -262,7 +539,7 @@ def get_sources():
     return jsonify(sources)
 
 
-@application.route('/api/messages', methods=['GET'])
+@blueprint.route('/api/messages', methods=['GET'])
 def api_messages():
     source_type = request.args.get('source_type')
     source_id = request.args.get('source_id')
@@ -282,23 +559,47 @@ def api_messages():
         }
     else:
         return {'error': "Parameter 'source_id' or 'user_id' is required."}, 400
-    messages = []
-    cursor = message_collection.find(query).sort('created_at', 1)
-    for row in cursor:
-        user_id = row.get('user_id', '')
-        user = user_collection.find_one({'user_id': user_id})
-        messages.append({
+    query['media_pending'] = {'$exists': False}
+    cursor = message_collection.find(query, MESSAGE_PROJECTION).sort('created_at', 1).batch_size(BATCH_SIZE)
+    return json_stream_response(message_batches(cursor))
+
+
+def message_batches(cursor):
+    user_names = {}
+    for rows in iter_batches(cursor):
+        user_ids = {row.get('user_id', '') for row in rows} - user_names.keys()
+        user_names.update({user_id: user_id for user_id in user_ids})
+        for user in user_collection.find({'user_id': {'$in': list(user_ids)}}):
+            user_names[user['user_id']] = user.get('username')
+        timestamps = format_timestamps(rows)
+        yield [{
             'type': row.get('message_type'),
             'content': row.get('message_content'),
             'user_id': row.get('user_id'),
             'target_id': row.get('target_id'),
-            'user_name': user.get('username') if user else user_id,
-            'timestamp': row.get('created_at').strftime('%Y-%m-%d %H:%M:%S')
-        })
-    return jsonify(messages)
+            'user_name': user_names[row.get('user_id', '')],
+            'timestamp': timestamp
+        } for row, timestamp in zip(rows, timestamps)]
+
+
+@blueprint.route('/api/stats/<group_by>', methods=['GET'])
+def api_stats(group_by):
+    try:
+        group_by, granularity, start, end = parse_stats_args(group_by, request.args)
+        ids = parse_int_args(request.args, ('source_id', 'user_id', 'target_id'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    filters = {
+        'source_type': request.args.get('source_type'),
+        **ids,
+        'message_type': request.args.get('message_type')
+    }
+    return jsonify(query_rollups(
+        rollup_collection, ROLLUP_FIELDS, group_by, granularity, filters, start, end, peer_field='target_id'
+    ))
 
 
-@application.route('/api/send_message', methods=['POST'])
+@blueprint.route('/api/send_message', methods=['POST'])
 def send_message():
     data = request.json
     source_type = data.get('source_type')
@@ -308,14 +609,32 @@ def send_message():
         return jsonify({'error': 'Missing required parameters'}), 400
     try:
         print('[send_message] telegram_loop ->', telegram_loop)
-        coroutine = bot_client.send_message(int(target_id), message)
+        coroutine = get_clients()[1].send_message(int(target_id), message)
         asyncio.run_coroutine_threadsafe(coroutine, telegram_loop)
         return jsonify({'status': 'Message sent'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+def create_app():
+    app = Flask(__name__)
+    app.config['CORS_HEADERS'] = 'Content-Type'
+    app.config['CORS_RESOURCES'] = {r'/api/*': {'origins': '*'}}
+    app.config['PROPAGATE_EXCEPTIONS'] = True
+    app.register_blueprint(blueprint)
+    return app
+
+
+application = create_app()
+
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'rebuild-stats':
+        rebuild_rollups(message_collection, rollup_collection, ROLLUP_FIELDS)
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'backfill':
+        asyncio.run(backfill(download_media='--media' in sys.argv))
+        sys.exit(0)
     t = threading.Thread(target=start_telethon_loop, daemon=True)
     t.start()
     application.run(host='0.0.0.0', port=5050)